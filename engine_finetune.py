@@ -9,20 +9,92 @@
 # BEiT: https://github.com/microsoft/unilm/tree/master/beit
 # --------------------------------------------------------
 
-import math
+import contextlib
 import sys
 from typing import Iterable, Optional
-import itertools
 import seaborn as sns
 import torch
-from sklearn.metrics import confusion_matrix
+import torch.distributed as dist
 from timm.data import Mixup
-from timm.utils import accuracy
 
+import matplotlib
+matplotlib.use('Agg')  # headless backend, skips tk/qt init in training jobs
 import matplotlib.pyplot as plt
 import util.misc as misc
 import util.lr_sched as lr_sched
-from sklearn.metrics import accuracy_score, f1_score
+
+_backend_flags_set = False
+
+def _setup_backend_flags():
+    # one-time TF32/cudnn knobs; benchmark is safe since batch shapes are fixed (drop_last=True)
+    global _backend_flags_set
+    if _backend_flags_set or not torch.cuda.is_available():
+        return
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    _backend_flags_set = True
+
+
+def _confusion_matrix(targets, preds, num_classes):
+    """Confusion matrix via one fused bincount on device; sklearn loops over labels in Python."""
+    return torch.bincount(targets * num_classes + preds,
+                          minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def _weighted_f1(cm):
+    """Weighted F1 from a confusion matrix, on whatever device the matrix lives on."""
+    cm = cm.float()
+    tp = cm.diag()
+    support = cm.sum(1)       # true counts per class
+    pred_count = cm.sum(0)    # predicted counts per class
+    denom = support + pred_count
+    f1 = torch.where(denom > 0, 2 * tp / denom.clamp(min=1), torch.zeros_like(tp))
+    return ((f1 * support).sum() / support.sum()).item()
+
+
+def _save_cm(cm, labels, title, acc, path):
+    """Render one confusion-matrix heatmap to disk without opening a figure window."""
+    fig, ax = plt.subplots(figsize=(8, 8))
+    sns.heatmap(cm, ax=ax, annot=True, cmap='Blues', fmt='d', xticklabels=labels,
+                yticklabels=labels, cbar=False, linewidth=.5, annot_kws={"fontsize":16})
+    ax.set_xlabel('Predicted Labels', fontsize=13)
+    ax.set_ylabel('True Labels', fontsize=13)
+    ax.set_title(f'{title}; Accuracy = {acc:.3f}')
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+
+
+def _maybe_compile_step(model, criterion, args, cache_key):
+    """Compile forward+loss as one callable (cached per model) so Inductor can fuse the
+    cross-entropy reduction into the tail of the forward instead of writing the logits back.
+    Returns None when compilation is disabled or unavailable, i.e. run eager."""
+    if not getattr(args, 'compile', False):
+        return None
+    if not hasattr(torch, 'compile'):
+        print("torch.compile not available in this torch version, running eager")
+        return None
+    step = model.__dict__.get(cache_key)  # plain dict slot to avoid nn.Module submodule registration
+    if step is None:
+        def _step(x, y):
+            out = model(x)
+            return criterion(out, y), out
+        step = torch.compile(_step, mode=getattr(args, 'compile_mode', None) or 'reduce-overhead',
+                             fullgraph=False, dynamic=False)
+        model.__dict__[cache_key] = step
+    return step
+
+
+def _check_loader_settings(data_loader, device):
+    """The non_blocking HtoD copies and the CUDAPrefetcher only overlap when the
+    loader pins memory, and without persistent workers every epoch pays a worker
+    respawn. Fail fast / warn rather than silently halving throughput."""
+    if device.type != 'cuda' or not isinstance(data_loader, torch.utils.data.DataLoader):
+        return
+    assert data_loader.pin_memory, "DataLoader must use pin_memory=True for non_blocking HtoD copies"
+    if data_loader.num_workers > 0 and not getattr(data_loader, 'persistent_workers', False):
+        print("Warning: DataLoader persistent_workers=False, workers respawn every epoch")
+
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
@@ -30,6 +102,10 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     mixup_fn: Optional[Mixup] = None, log_writer=None, device =torch.device, 
                     args=None):
     model.train(True)
+    _setup_backend_flags()
+    _check_loader_settings(data_loader, device)
+    ddp_model = model if isinstance(model, torch.nn.parallel.DistributedDataParallel) else None
+    step_fn = _maybe_compile_step(model, criterion, args, '_compiled_train_step')
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
@@ -37,65 +113,120 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 
     accum_iter = args.accum_iter
 
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
 
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    # bf16 needs no GradScaler; fp16 keeps the existing loss_scaler path
+    amp_dtype = torch.float16 if getattr(args, 'amp_dtype', 'bf16') == 'fp16' else torch.bfloat16
+    use_amp = getattr(args, 'amp_dtype', 'bf16') != 'off'
+
+    channels_last = getattr(args, 'channels_last', False)
+    # the fp16 GradScaler already rejects non-finite grads, so the explicit loss check
+    # is only needed for bf16/fp32 runs
+    check_finite = not (use_amp and amp_dtype is torch.float16)
+
+    stat_buf = None  # on-device [loss_sum, micro_steps] between log steps; one AllReduce per window
+
+    # the reduced window loss only feeds tensorboard, but the collective must be
+    # gated on a condition that is identical on every rank: log_writer is a
+    # per-rank object, and a reduce issued on one rank only would deadlock DDP.
+    # Mirror the writer-construction condition from the training scripts.
+    want_tb = getattr(args, 'log_dir', None) is not None and not getattr(args, 'eval', False)
+
+    # precompute the cosine/warmup schedule for the whole epoch so the hot loop
+    # only indexes a list instead of redoing transcendental math per update
+    steps_per_epoch = len(data_loader)
+    n_updates = (steps_per_epoch + accum_iter - 1) // accum_iter
+    epoch_lrs = [lr_sched.compute_lr(epoch + (i * accum_iter) / steps_per_epoch, args)
+                 for i in range(n_updates)]
+
+    # overlap the next batch's HtoD copy with the current step's compute
+    loader = misc.CUDAPrefetcher(data_loader, device) if device.type == 'cuda' else data_loader
+
+    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(loader, print_freq, header)):
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+            lr = epoch_lrs[data_iter_step // accum_iter]
+            for group in optimizer.param_groups:
+                if "lr_scale" in group:
+                    group["lr"] = lr * group["lr_scale"]
+                else:
+                    group["lr"] = lr
+            # lr only changes here, so scan the param groups here rather than every micro-step
+            lrs = [group["lr"] for group in optimizer.param_groups]
+            min_lr = min(lrs)
+            max_lr = max(lrs)
 
         samples = samples.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
+        if channels_last and samples.dim() == 4:
+            samples = samples.contiguous(memory_format=torch.channels_last)
 
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
 
-        #with torch.cuda.amp.autocast(): #changed -> hashed out for 'cpu'
-        outputs = model(samples)
-        loss = criterion(outputs, targets)
-
-        
-        loss_value = loss.item()
-
-
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
-
-        loss /= accum_iter
-        loss_scaler(loss, optimizer, clip_grad=max_norm,
-                    parameters=model.parameters(), create_graph=False,
-                    update_grad=(data_iter_step + 1) % accum_iter == 0)
-        if (data_iter_step + 1) % accum_iter == 0:
-            optimizer.zero_grad()
+        update_grad = (data_iter_step + 1) % accum_iter == 0
+
+        # skip the DDP gradient AllReduce on micro-steps that don't update the optimizer
+        if ddp_model is not None and not update_grad:
+            sync_ctx = ddp_model.no_sync()
+        else:
+            sync_ctx = contextlib.nullcontext()
+
+        with sync_ctx:
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp): #changed -> device-agnostic, works on 'cpu' too
+                if step_fn is not None:
+                    loss, outputs = step_fn(samples, targets)
+                else:
+                    outputs = model(samples)
+                    loss = criterion(outputs, targets)
+
+            # keep the loss on device; .item() below only on log steps
+            loss_value_t = loss.detach()
+            if stat_buf is None:
+                stat_buf = torch.zeros(2, device=loss_value_t.device)
+            stat_buf[0] += loss_value_t
+            stat_buf[1] += 1
+
+            loss /= accum_iter
+            loss_scaler(loss, optimizer, clip_grad=max_norm,
+                        parameters=model.parameters(), create_graph=False,
+                        update_grad=update_grad)
+        if update_grad:
+            optimizer.zero_grad(set_to_none=True)  # frees grads instead of an O(params) memset
 
         #torch.cuda.synchronize() #changed -> hashed out for 'cpu'
 
-        metric_logger.update(loss=loss_value)
-
-        min_lr = 10.
-        max_lr = 0.
-        for group in optimizer.param_groups:
-            min_lr = min(min_lr, group["lr"])
-            max_lr = max(max_lr, group["lr"])
-
-        metric_logger.update(lr=max_lr)
-
-        loss_value_reduce = misc.all_reduce_mean(loss_value)
-
-
-        if log_writer is not None and (data_iter_step + 1) % accum_iter == 0:
-            """ We use epoch_1000x as the x-axis in tensorboard.
-            This calibrates different curves when batch size changes.
-            """
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
-            log_writer.add_scalar('loss', loss_value_reduce, epoch_1000x)
-            log_writer.add_scalar('lr', max_lr, epoch_1000x)
+        # materialize the windowed loss only when the logger is about to print
+        if data_iter_step % print_freq == 0 or data_iter_step == steps_per_epoch - 1:
+            # one AllReduce on the 2-slot buffer replaces a collective per scalar;
+            # skipped entirely when tensorboard logging is off for this run
+            if want_tb and misc.get_world_size() > 1:
+                dist.all_reduce(stat_buf)
+            loss_window_mean = stat_buf[0] / stat_buf[1]
+            stat_buf = None
+
+            # inf/nan propagate through the window sum, so one on-device check covers
+            # every step since the last log; materialized only on failure
+            if check_finite and not torch.isfinite(loss_window_mean):
+                print("Loss is {}, stopping training".format(loss_window_mean.item()))
+                sys.exit(1)
+
+            loss_value = loss_window_mean.item()
+
+            metric_logger.update(loss=loss_value)
+            metric_logger.update(lr=max_lr)
+
+            if log_writer is not None:
+                """ We use epoch_1000x as the x-axis in tensorboard.
+                This calibrates different curves when batch size changes.
+                """
+                epoch_1000x = int((data_iter_step / steps_per_epoch + epoch) * 1000)
+                log_writer.add_scalar('loss', loss_value, epoch_1000x)  # already the cross-rank mean when reduced
+                log_writer.add_scalar('lr', max_lr, epoch_1000x)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -104,46 +235,94 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 
 
 @torch.no_grad()
-def evaluate(data_loader, model, device, args, confusion_matrix_plot=False, RISE_collapse_labels=False, plot_save_name=None, plot_title=None):
+def evaluate(data_loader, model, device, args=None, confusion_matrix_plot=False, RISE_collapse_labels=False, plot_save_name=None, plot_title=None):
     criterion = torch.nn.CrossEntropyLoss()
 
     metric_logger = misc.MetricLogger(delimiter="  ")
     header = 'Test:'
+    print_freq = 10
 
     # switch to evaluation mode
     model.eval()
-
-    
-    preds = list()
-    targets = list()
-
-    for batch in metric_logger.log_every(data_loader, 10, header):
+    _setup_backend_flags()
+    _check_loader_settings(data_loader, device)
+    step_fn = _maybe_compile_step(model, criterion, args, '_compiled_eval_step')
+
+    # same dtype selection as train_one_epoch; fp16 exists for GPUs without bf16
+    amp_dtype = torch.float16 if getattr(args, 'amp_dtype', 'bf16') == 'fp16' else torch.bfloat16
+    use_amp = getattr(args, 'amp_dtype', 'bf16') != 'off'
+    channels_last = getattr(args, 'channels_last', False)
+
+
+    # stateful metric accumulation: a running confusion matrix on device is the
+    # only state kept across batches (O(C^2) instead of growing prediction lists)
+    cm_state = None
+
+    # per-batch scalars buffered on device; one sync per print_freq window
+    loss_buf = list()
+    acc1_buf = list()
+    acc3_buf = list()
+    bs_buf = list()
+
+    def _flush_meters():
+        if not loss_buf:
+            return
+        losses = torch.stack(loss_buf).tolist()
+        acc1s = torch.stack(acc1_buf).tolist()
+        acc3s = torch.stack(acc3_buf).tolist()
+        for lv, a1, a3, n in zip(losses, acc1s, acc3s, bs_buf):
+            metric_logger.update(loss=lv)
+            metric_logger.meters['acc1'].update(a1, n=n)
+            metric_logger.meters['acc3'].update(a3, n=n)
+        loss_buf.clear()
+        acc1_buf.clear()
+        acc3_buf.clear()
+        bs_buf.clear()
+
+    # overlap the next batch's HtoD copy with the current step's compute
+    loader = misc.CUDAPrefetcher(data_loader, device) if device.type == 'cuda' else data_loader
+
+    for batch_idx, batch in enumerate(metric_logger.log_every(loader, print_freq, header)):
         images = batch[0]
         target = batch[-1]
         images = images.to(device, non_blocking=True)
         target = target.to(device, non_blocking=True)
+        if channels_last and images.dim() == 4:
+            images = images.contiguous(memory_format=torch.channels_last)
 
         # compute output
-        with torch.cuda.amp.autocast():
-            output = model(images)
-            loss = criterion(output, target)
-            pred = torch.argmax(output.detach(), axis=1)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp): #changed -> device-agnostic so cpu eval doesn't crash
+            if step_fn is not None:
+                loss, output = step_fn(images, target)
+            else:
+                output = model(images)
+                loss = criterion(output, target)
+
+        # one topk gives the hard prediction and both accuracies; argmax + timm's
+        # accuracy() would reduce over the logits twice
+        _, top3 = output.detach().topk(3, dim=1)
+        pred = top3[:, 0]
         
-        preds.append(pred.cpu().numpy().tolist())
-        targets.append(target.cpu().numpy().tolist())
+        # stay on device; materialized once after the loop
+        num_classes = output.shape[1]
+        if cm_state is None:
+            cm_state = torch.zeros(num_classes, num_classes, dtype=torch.long, device=pred.device)
+        cm_state += _confusion_matrix(target, pred, num_classes)
 
+        acc1 = (pred == target).float().mean() * 100.    # changed - to top 3
+        acc3 = (top3 == target.unsqueeze(1)).any(dim=1).float().mean() * 100.
 
-        acc1, acc3 = accuracy(output, target, topk=(1, 3))     # changed - to top 3
-        f1 = f1_score(target.cpu().numpy(), pred.cpu().numpy(), average='weighted')
-        metric_logger.update(F1=f1)  
-        
-        batch_size = images.shape[0]
-        metric_logger.update(loss=loss.item())
+        loss_buf.append(loss.detach())
+        acc1_buf.append(acc1)
+        acc3_buf.append(acc3)
+        bs_buf.append(images.shape[0])
+        # flush just before log_every prints so the meters are fresh
+        if batch_idx % print_freq == 0:
+            _flush_meters()
 
-        metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-        metric_logger.meters['acc3'].update(acc3.item(), n=batch_size)
+    _flush_meters()
 
-    
+    metric_logger.update(F1=_weighted_f1(cm_state))
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -153,55 +332,36 @@ def evaluate(data_loader, model, device, args, confusion_matrix_plot=False, RISE
         f'F1 {metric_logger.meters["F1"].global_avg:.3f}')
 
 
-    if confusion_matrix_plot:
-        preds_list = list(itertools.chain.from_iterable(preds))
-        targets_list = list(itertools.chain.from_iterable(targets))
+    if confusion_matrix_plot and misc.is_main_process():
+        cm_test = cm_state.cpu()
         if args.data == "UCIHAR":
             labels = ['Transition', 'Walking', 'Walking-upstairs', 'Walking-downstairs', 'Sitting', 'Standing', 'Laying']
         if args.data == "RISE":
             labels = ["sedentary", "standing", "stepping", "cycling", "primary_lying", "secondary_lying", "seated_transport"]
 
-        preds_tensor = torch.tensor(preds_list)
-        targets_tensor = torch.tensor(targets_list)
-
-        final_accordance = (preds_tensor == targets_tensor)
-        final_acc1 = final_accordance.sum().item() / len(preds_list)
+        final_acc1 = (cm_test.diag().sum() / cm_test.sum()).item()
 
         # plot confusion matrix
-        cm_test = confusion_matrix(targets_list, preds_list)
-        plt.figure(figsize=(8, 8))
-        sns.heatmap(cm_test, annot=True, cmap='Blues', fmt='d', xticklabels=labels,
-                    yticklabels=labels, cbar=False, linewidth=.5, annot_kws={"fontsize":16})
-        plt.xlabel('Predicted Labels', fontsize=13)
-        plt.ylabel('True Labels', fontsize=13)
-        plt.title(f'{plot_title}; Accuracy = {final_acc1:.3f}')
-        plt.show()
-        plt.savefig(f'/niddk-data-central/P2/mae_hr/MAE_Accelerometer/plots/{plot_save_name}_confusion_matrix.png', bbox_inches='tight')
+        _save_cm(cm_test.numpy(), labels, plot_title, final_acc1,
+                 f'/niddk-data-central/P2/mae_hr/MAE_Accelerometer/plots/{plot_save_name}_confusion_matrix.png')
 
         if RISE_collapse_labels:
             mapping = {0:0, 1:1, 2:1, 3:1, 4:0, 5:0, 6:0}
-            preds_list_bin = [mapping[x] for x in preds_list]
-            targets_list_bin = [mapping[x] for x in targets_list]
+            # one vectorized gather instead of a per-element dict lookup
+            lut = torch.tensor([mapping[i] for i in range(len(mapping))], dtype=torch.long)
             labels = ['Sedentary', 'Active']
 
-            preds_bin_tensor = torch.tensor(preds_list_bin)
-            targets_bin_tensor = torch.tensor(targets_list_bin)
+            # collapse the full matrix with the same lut:
+            # cm_test_bin[a, b] = sum of cm_test[i, j] over lut[i]==a, lut[j]==b
+            onehot = torch.zeros(len(lut), 2, dtype=cm_test.dtype)
+            onehot[torch.arange(len(lut)), lut] = 1
+            cm_test_bin = onehot.t() @ cm_test @ onehot
 
-            final_bin_accordance = (preds_bin_tensor == targets_bin_tensor)
-            final_bin_acc1 = final_bin_accordance.sum().item() / len(preds_list)
+            final_bin_acc1 = (cm_test_bin.diag().sum() / cm_test_bin.sum()).item()
 
             # plot the confusion matrix - binary version
-            cm_test_bin = confusion_matrix(targets_list_bin, preds_list_bin)
-
-
-            plt.figure(figsize=(8, 8))
-            sns.heatmap(cm_test_bin, annot=True, cmap='Blues', fmt='d', xticklabels=labels,
-                        yticklabels=labels, cbar=False, linewidth=.5, annot_kws={"fontsize":16})
-            plt.xlabel('Predicted Labels', fontsize=13)
-            plt.ylabel('True Labels', fontsize=13)
-            plt.title(f'{plot_title}(binary); Accuracy = {final_bin_acc1:.3f}')
-            plt.show()
-            plt.savefig(f'/niddk-data-central/P2/mae_hr/MAE_Accelerometer/plots/{plot_save_name}_bin_confusion_matrix.png', bbox_inches='tight')
+            _save_cm(cm_test_bin.numpy(), labels, f'{plot_title}(binary)', final_bin_acc1,
+                     f'/niddk-data-central/P2/mae_hr/MAE_Accelerometer/plots/{plot_save_name}_bin_confusion_matrix.png')
 
 
 
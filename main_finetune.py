@@ -78,6 +78,17 @@ def get_args_parser():
     parser.set_defaults(finetune_interpolate_patches=False) # changed - added
 
 
+    parser.add_argument('--amp_dtype', default='bf16', type=str, choices=['bf16', 'fp16', 'off'],
+                        help='autocast dtype for train/eval forward; bf16 skips grad scaling') # changed - added
+    parser.add_argument('--compile', action='store_true',
+                        help='wrap the model with torch.compile for train/eval') # changed - added
+    parser.set_defaults(compile=False) # changed - added
+    parser.add_argument('--compile_mode', default='reduce-overhead', type=str,
+                        help='torch.compile mode (default: reduce-overhead)') # changed - added
+    parser.add_argument('--channels_last', action='store_true',
+                        help='use channels_last memory format for model and inputs') # changed - added
+    parser.set_defaults(channels_last=False) # changed - added
+
     # Optimizer parameters
     parser.add_argument('--clip_grad', type=float, default=None, metavar='NORM',
                         help='Clip gradient norm (default: None, no clipping)')
@@ -290,20 +301,25 @@ def main(args):
     else:
         log_writer = None
 
+    # shared loader settings: persistent workers avoid a respawn every epoch and a
+    # deeper prefetch keeps the pinned-memory pipeline ahead of the GPU copies
+    loader_kwargs = dict(num_workers=args.num_workers, pin_memory=args.pin_mem)
+    if args.num_workers > 0:
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 4
+
     data_loader_train = torch.utils.data.DataLoader(
         dataset_train, sampler=sampler_train,
         batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_mem,
         drop_last=True,
+        **loader_kwargs,
     )
 
     data_loader_val = torch.utils.data.DataLoader(
         dataset_val, sampler=sampler_test,
         batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_mem,
-        drop_last=False
+        drop_last=False,
+        **loader_kwargs,
     )
 
     mixup_fn = None
@@ -369,6 +385,8 @@ def main(args):
         trunc_normal_(model.head.weight, std=2e-5)
 
     model.to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)  # NHWC cuDNN fast path for the conv patch embed
 
     model_without_ddp = model
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -397,7 +415,7 @@ def main(args):
         layer_decay=args.layer_decay
     )
     optimizer = torch.optim.AdamW(param_groups, lr=args.lr)
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=args.amp_dtype == 'fp16')  # bf16/off need no scaling
 
     if mixup_fn is not None:
         # smoothing is handled with mixup label transform
@@ -412,7 +430,7 @@ def main(args):
     misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler) 
 
     if args.eval:
-        test_stats = evaluate(data_loader=data_loader_val, model=model, device=device,
+        test_stats = evaluate(data_loader=data_loader_val, model=model, device=device, args=args,
         confusion_matrix_plot=args.confusion_matrix_plot, RISE_collapse_labels=args.RISE_collapse_labels, plot_save_name=args.plot_save_name, plot_title=args.plot_title)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
         exit(0)
@@ -435,7 +453,7 @@ def main(args):
                 args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
                 loss_scaler=loss_scaler, epoch=epoch)
 
-        test_stats = evaluate(data_loader_val, model, device)
+        test_stats = evaluate(data_loader_val, model, device, args=args)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
         max_accuracy = max(max_accuracy, test_stats["acc1"])
         print(f'Max accuracy: {max_accuracy:.2f}%')
@@ -168,6 +168,45 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 
+class CUDAPrefetcher:
+    """Wrap a DataLoader so the next batch is copied to the GPU on a side stream
+    while the current batch is being computed, hiding the HtoD transfer.
+    The copies are only truly async when the loader uses pin_memory=True.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return [x.to(self.device, non_blocking=True) if isinstance(x, torch.Tensor) else x
+                    for x in batch]
+
+    def __iter__(self):
+        it = iter(self.loader)
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            batch = next_batch
+            # gate compute only on the copy already in flight, then queue the next
+            # one; waiting after the next preload would make compute of batch i
+            # depend on batch i+1's transfer as well
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for x in batch:
+                if isinstance(x, torch.Tensor):
+                    x.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(it)
+            yield batch
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -252,8 +291,9 @@ def init_distributed_mode(args):
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        # enabled=False makes scale/unscale no-ops (bf16 autocast needs no scaling)
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled)
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)